@@ -1,9 +1,17 @@
 ﻿#!/usr/bin/env python3
 import os
+from functools import lru_cache
 from typing import Optional
 
 
+_DOTENV_LOADED = False
+
+
 def load_dotenv_if_available() -> None:
+    global _DOTENV_LOADED
+    if _DOTENV_LOADED:
+        return
+    _DOTENV_LOADED = True
     try:
         from dotenv import load_dotenv  # type: ignore
         load_dotenv()
@@ -27,10 +35,12 @@ def openai_model_default() -> str:
     return env_str("OPENAI_MODEL", "o3") or "o3"
 
 
+@lru_cache(maxsize=1)
 def get_openai_client():
     """
     Returns an OpenAI client using the API key from env.
     Respects optional OPENAI_BASE_URL for self-hosted gateways.
+    The client is cached so repeated calls share one connection pool.
     """
     load_dotenv_if_available()
     from openai import OpenAI  # type: ignore
@@ -43,6 +53,24 @@ def get_openai_client():
     return OpenAI(api_key=api_key)
 
 
+def get_async_openai_client():
+    """
+    Async counterpart of get_openai_client for use inside an event loop.
+    Not cached: its connection pool is bound to the loop that first uses it,
+    so callers should close it (async with) before that loop ends.
+    """
+    load_dotenv_if_available()
+    from openai import AsyncOpenAI  # type: ignore
+
+    api_key = require_env("OPENAI_API_KEY")
+    base_url = env_str("OPENAI_BASE_URL")
+
+    if base_url:
+        return AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return AsyncOpenAI(api_key=api_key)
+
+
+@lru_cache(maxsize=1)
 def get_vision_client():
     """
     Returns a Google Cloud Vision ImageAnnotatorClient configured with an API key
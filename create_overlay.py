@@ -1,32 +1,59 @@
 ﻿#!/usr/bin/env python3
 import argparse
-import json
+import math
 import os
+from functools import lru_cache
+
 from PIL import Image, ImageDraw, ImageFont
 
+from json_io import read_json
+
+try:
+    import pyvips  # type: ignore
+except Exception:
+    # pyvips (and libvips) is optional; Pillow's encoder is used otherwise
+    pyvips = None
+
+# Below this size Pillow's PNG encoder is fast enough to not be worth the copy
+VIPS_MIN_PIXELS = 4_000_000
+
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/System/Library/Fonts/Arial.ttf",  # macOS
+    "arial.ttf",  # Windows
+]
+_FONT_PATH = next((p for p in FONT_PATHS if os.path.exists(p)), None)
+
+# Shared scratch surface for text measurement
+_MEASURE_IMG = Image.new('L', (1, 1))
+_MEASURE_DRAW = ImageDraw.Draw(_MEASURE_IMG)
+
 
 def load_corrections(corrections_file="corrections.json"):
-    with open(corrections_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = read_json(corrections_file)
     return data.get('corrections', []), data.get('overall_assessment', {})
 
 
+@lru_cache(maxsize=None)
 def get_font(size=20):
     try:
-        font_paths = [
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-            "/System/Library/Fonts/Arial.ttf",  # macOS
-            "arial.ttf",  # Windows
-        ]
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                return ImageFont.truetype(font_path, size)
+        if _FONT_PATH:
+            return ImageFont.truetype(_FONT_PATH, size)
     except Exception:
         pass
     return ImageFont.load_default()
 
 
+def save_png(image, path):
+    # Outputs are intermediates, so favour encode speed over size
+    if pyvips is not None and image.mode == 'RGBA' and image.width * image.height > VIPS_MIN_PIXELS:
+        vips_image = pyvips.Image.new_from_memory(image.tobytes(), image.width, image.height, 4, 'uchar')
+        vips_image.write_to_file(path, compression=1)
+        return
+    image.save(path, optimize=False, compress_level=1)
+
+
 def draw_overall_assessment(draw, assessment, img_width, img_height, font_size, y_offset=50):
     start_y = img_height + y_offset
     green_color = (0, 150, 0, 255)
@@ -72,25 +99,37 @@ def draw_overall_assessment(draw, assessment, img_width, img_height, font_size,
     return current_y
 
 
+@lru_cache(maxsize=4096)
+def _measure(font, text):
+    # Fonts come from the get_font cache, so identity keys stay valid
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=4096)
+def _text_size(font, text):
+    left, top, right, bottom = _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
 def wrap_text(text, font, max_width):
     words = text.split()
     lines = []
     current_line = []
-    test_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    current_width = 0.0
+    space_width = _measure(font, ' ')
 
+    # Accumulate per-word advances instead of re-measuring the whole line
     for word in words:
-        test_line = ' '.join(current_line + [word])
-        try:
-            bbox = test_draw.textbbox((0, 0), test_line, font=font)
-            text_width = bbox[2] - bbox[0]
-        except Exception:
-            text_width, _ = test_draw.textsize(test_line, font=font)
+        word_width = _measure(font, word)
+        text_width = current_width + space_width + word_width if current_line else word_width
         if text_width <= max_width:
             current_line.append(word)
+            current_width = text_width
         else:
             if current_line:
                 lines.append(' '.join(current_line))
                 current_line = [word]
+                current_width = word_width
             else:
                 lines.append(word)
     if current_line:
@@ -98,15 +137,64 @@ def wrap_text(text, font, max_width):
     return lines
 
 
-def create_overlay(image_path, corrections, assessment, font_size=32, output_path="corrected_overlay.png"):
+class ShapeRecorder:
+    """
+    Stands in for ImageDraw.Draw while laying out correction marks so the
+    area they cover is known before any canvas is allocated.
+    """
+
+    def __init__(self):
+        self.shapes = []
+        self.bounds = None
+
+    def _extend(self, left, top, right, bottom):
+        # Model bboxes may be floats; keep tile sizes and replay offsets integral
+        left, top = math.floor(left), math.floor(top)
+        right, bottom = math.ceil(right), math.ceil(bottom)
+        if self.bounds is None:
+            self.bounds = (left, top, right, bottom)
+        else:
+            b = self.bounds
+            self.bounds = (min(b[0], left), min(b[1], top), max(b[2], right), max(b[3], bottom))
+
+    def _record(self, method, xy, pad=0, **kwargs):
+        xs = [p[0] for p in xy]
+        ys = [p[1] for p in xy]
+        self._extend(min(xs) - pad, min(ys) - pad, max(xs) + pad + 1, max(ys) + pad + 1)
+        self.shapes.append((method, xy, kwargs))
+
+    def line(self, xy, fill=None, width=0):
+        self._record('line', xy, pad=width // 2 + 1, fill=fill, width=width)
+
+    def ellipse(self, xy, outline=None, width=1):
+        self._record('ellipse', xy, outline=outline, width=width)
+
+    def rectangle(self, xy, outline=None, width=1):
+        self._record('rectangle', xy, outline=outline, width=width)
+
+    def text(self, xy, text, fill=None, font=None):
+        left, top, right, bottom = font.getbbox(text)
+        x, y = xy
+        self._extend(x + left, y + top, x + right, y + bottom)
+        self.shapes.append(('text', [xy], {'text': text, 'fill': fill, 'font': font}))
+
+    def replay(self, draw, dx=0, dy=0):
+        for method, xy, kwargs in self.shapes:
+            points = [(x - dx, y - dy) for x, y in xy]
+            if method == 'text':
+                draw.text(points[0], **kwargs)
+            else:
+                getattr(draw, method)(points, **kwargs)
+
+
+def create_overlay(image_path, corrections, assessment, font_size=32, output_path="corrected_overlay.png", save_overlay=False):
     original = Image.open(image_path).convert('RGBA')
     img_width, img_height = original.size
 
     assessment_height = int(font_size * 20)
     total_height = img_height + assessment_height
 
-    overlay = Image.new('RGBA', (img_width, total_height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
+    draw = ShapeRecorder()
     font = get_font(font_size)
     mark_size = int(font_size * 1.2)
 
@@ -147,13 +235,7 @@ def create_overlay(image_path, corrections, assessment, font_size=32, output_pat
 
             corrected_text = correction.get('corrected_text', '')
             if corrected_text and corrected_text != correction.get('original_text', ''):
-                test_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
-                try:
-                    text_bbox = test_draw.textbbox((0, 0), corrected_text, font=font)
-                    text_width = text_bbox[2] - text_bbox[0]
-                    text_height = text_bbox[3] - text_bbox[1]
-                except Exception:
-                    text_width, text_height = test_draw.textsize(corrected_text, font=font)
+                text_width, text_height = _text_size(font, corrected_text)
 
                 text_x = bottom_right[0] + mark_size + 10
                 text_y = top_left[1]
@@ -170,17 +252,36 @@ def create_overlay(image_path, corrections, assessment, font_size=32, output_pat
         elif status == 'ignore':
             pass
 
-    draw_overall_assessment(draw, assessment, img_width, img_height, font_size)
-
-    overlay.save(output_path)
-
-    extended_original = Image.new('RGBA', (img_width, total_height), (255, 255, 255, 255))
-    extended_original.paste(original, (0, 0))
-    composite = Image.alpha_composite(extended_original, overlay)
+    # Correction marks go on a tile sized to their union, clipped to the canvas
+    tiles = []
+    if draw.bounds is not None:
+        left, top, right, bottom = draw.bounds
+        left, top = max(0, left), max(0, top)
+        right, bottom = min(img_width, right), min(total_height, bottom)
+        if right > left and bottom > top:
+            tile = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+            draw.replay(ImageDraw.Draw(tile), left, top)
+            tiles.append((tile, (left, top)))
+
+    # The assessment panel is drawn on its own strip below the image
+    strip = Image.new('RGBA', (img_width, assessment_height), (0, 0, 0, 0))
+    draw_overall_assessment(ImageDraw.Draw(strip), assessment, img_width, 0, font_size)
+    tiles.append((strip, (0, img_height)))
+
+    composite = Image.new('RGBA', (img_width, total_height), (255, 255, 255, 255))
+    composite.paste(original, (0, 0))
+    for tile, dest in tiles:
+        composite.alpha_composite(tile, dest)
     composite_path = output_path.replace('.png', '_complete.png')
-    composite.save(composite_path)
 
-    return output_path, composite_path
+    if save_overlay:
+        overlay = Image.new('RGBA', (img_width, total_height), (0, 0, 0, 0))
+        for tile, dest in tiles:
+            overlay.alpha_composite(tile, dest)
+        save_png(overlay, output_path)
+    save_png(composite, composite_path)
+
+    return (output_path if save_overlay else None), composite_path
 
 
 def main():
@@ -189,10 +290,11 @@ def main():
     ap.add_argument('--corrections', required=True, help='Path to corrections.json')
     ap.add_argument('--output', default='corrected_overlay.png', help='Output PNG path')
     ap.add_argument('--font-size', type=int, default=32)
+    ap.add_argument('--save-overlay', action='store_true', help='Also write the transparent overlay PNG')
     args = ap.parse_args()
 
     corrections, assessment = load_corrections(args.corrections)
-    create_overlay(args.image, corrections, assessment, args.font_size, args.output)
+    create_overlay(args.image, corrections, assessment, args.font_size, args.output, save_overlay=args.save_overlay)
 
 
 if __name__ == '__main__':
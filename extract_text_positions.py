@@ -1,26 +1,40 @@
 ﻿#!/usr/bin/env python3
 import argparse
-import json
 import os
-from typing import List, Dict, Tuple
+from io import BytesIO
+from typing import List, Dict, NamedTuple, Tuple
 
 from PIL import Image, ImageDraw, ImageFont
 from google.cloud import vision
 
+try:
+    import numpy as np  # type: ignore
+    from scipy.sparse import coo_matrix  # type: ignore
+    from scipy.sparse.csgraph import connected_components  # type: ignore
+    from scipy.spatial import cKDTree  # type: ignore
+except Exception:
+    # Grouping falls back to a pure-Python pairwise scan over box dicts
+    np = None
+
+from json_io import dumps, read_bytes
 from config import get_vision_client
 
 
 BBox = Dict[str, List[int]]
 Box = Dict[str, object]
 
+REGION_TEMPLATE = "Region %s:\nPosition: [%s,%s] to [%s,%s]\nStudent wrote: \"%s\"\n---\n"
+
 
-def extract_text_with_positions(image_path: str, use_adaptive_config: bool = True, custom_config: Dict = None) -> List[Box]:
+def extract_text_with_positions(image_path: str, use_adaptive_config: bool = True, custom_config: Dict = None) -> Tuple[List[Box], Tuple[int, int], bytes]:
+    """
+    Returns the grouped boxes, the image (width, height) and the raw image
+    bytes sent to Vision, so callers need not reopen or re-read the file.
+    """
     client = get_vision_client()
 
-    with open(image_path, 'rb') as f:
-        content = f.read()
-    img = Image.open(image_path)
-    img_width, img_height = img.size
+    content = read_bytes(image_path)
+    img_width, img_height = Image.open(BytesIO(content)).size
 
     image = vision.Image(content=content)
     response = client.document_text_detection(image=image)
@@ -59,54 +73,29 @@ def extract_text_with_positions(image_path: str, use_adaptive_config: bool = Tru
     if use_adaptive_config and not custom_config:
         config = adaptive_grouping_config(img_width, img_height)
     grouped = improved_group_nearby_boxes(words, config)
-    return grouped
-
-
-def calculate_box_center(bbox: BBox) -> Tuple[float, float]:
-    x1, y1 = bbox['top_left']
-    x2, y2 = bbox['bottom_right']
-    return ((x1 + x2) / 2.0, (y1 + y2) / 2.0)
-
-
-def boxes_are_horizontally_aligned(box1: Box, box2: Box, tolerance: float = 30) -> bool:
-    return abs(calculate_box_center(box1['bbox'])[1] - calculate_box_center(box2['bbox'])[1]) <= tolerance
-
-
-def boxes_are_vertically_aligned(box1: Box, box2: Box, tolerance: float = 50) -> bool:
-    return abs(calculate_box_center(box1['bbox'])[0] - calculate_box_center(box2['bbox'])[0]) <= tolerance
-
-
-def calculate_gap_between_boxes(box1: Box, box2: Box) -> float:
-    x1_right = box1['bbox']['bottom_right'][0]
-    x2_left = box2['bbox']['top_left'][0]
-    if x2_left >= x1_right:
-        return x2_left - x1_right
-    x2_right = box2['bbox']['bottom_right'][0]
-    x1_left = box1['bbox']['top_left'][0]
-    if x1_left >= x2_right:
-        return x1_left - x2_right
-    return 0.0
+    return grouped, (img_width, img_height), content
 
 
 def should_merge_boxes(box1: Box, box2: Box, config: Dict) -> bool:
-    max_horizontal_gap = int(config.get('max_horizontal_gap', 80))
-    max_vertical_gap = int(config.get('max_vertical_gap', 40))
-    h_tol = int(config.get('horizontal_alignment_tolerance', 25))
-    v_tol = int(config.get('vertical_alignment_tolerance', 40))
-
-    if boxes_are_horizontally_aligned(box1, box2, h_tol):
-        gap = calculate_gap_between_boxes(box1, box2)
+    max_horizontal_gap, max_vertical_gap, h_tol, v_tol = grouping_thresholds(config)
+    ax1, ay1 = box1['bbox']['top_left']
+    ax2, ay2 = box1['bbox']['bottom_right']
+    bx1, by1 = box2['bbox']['top_left']
+    bx2, by2 = box2['bbox']['bottom_right']
+
+    # Centers are compared on doubled coordinates to stay in integers
+    if abs((ay1 + ay2) - (by1 + by2)) <= 2 * h_tol:
+        gap = bx1 - ax2
+        if gap < 0:
+            gap = ax1 - bx2
+            if gap < 0:
+                gap = 0
         if gap <= max_horizontal_gap:
             return True
-    if boxes_are_vertically_aligned(box1, box2, v_tol):
-        b1 = box1['bbox']['bottom_right'][1]
-        t2 = box2['bbox']['top_left'][1]
-        if t2 >= b1 and (t2 - b1) <= max_vertical_gap:
-            return True
-        b2 = box2['bbox']['bottom_right'][1]
-        t1 = box1['bbox']['top_left'][1]
-        if t1 >= b2 and (t1 - b2) <= max_vertical_gap:
-            return True
+    if abs((ax1 + ax2) - (bx1 + bx2)) <= 2 * v_tol:
+        below = by1 - ay2
+        above = ay1 - by2
+        return 0 <= below <= max_vertical_gap or 0 <= above <= max_vertical_gap
     return False
 
 
@@ -140,6 +129,88 @@ def merge_boxes(boxes: List[Box]) -> Box:
     }
 
 
+class BoxArrays(NamedTuple):
+    x1: "np.ndarray"
+    y1: "np.ndarray"
+    x2: "np.ndarray"
+    y2: "np.ndarray"
+
+
+def box_arrays(boxes: List[Box]) -> BoxArrays:
+    coords = np.array([b['bbox']['top_left'] + b['bbox']['bottom_right'] for b in boxes], dtype=np.int32).reshape(-1, 4)
+    return BoxArrays(*(np.ascontiguousarray(coords[:, k]) for k in range(4)))
+
+
+def grouping_thresholds(config: Dict) -> Tuple[int, int, int, int]:
+    return (
+        int(config.get('max_horizontal_gap', 80)),
+        int(config.get('max_vertical_gap', 40)),
+        int(config.get('horizontal_alignment_tolerance', 25)),
+        int(config.get('vertical_alignment_tolerance', 40)),
+    )
+
+
+def candidate_pairs(arrays: BoxArrays, config: Dict) -> "np.ndarray":
+    """
+    Returns an (k, 2) array of index pairs (i < j) that could satisfy
+    should_merge_boxes, found by a KD-tree range query over box centers.
+    """
+    max_horizontal_gap, max_vertical_gap, h_tol, v_tol = grouping_thresholds(config)
+    centers = np.column_stack(((arrays.x1 + arrays.x2) / 2.0, (arrays.y1 + arrays.y2) / 2.0))
+    max_width = int((arrays.x2 - arrays.x1).max())
+    max_height = int((arrays.y2 - arrays.y1).max())
+    # Centers of mergeable boxes are at most this far apart on either axis
+    radius = max(max_horizontal_gap + max_width, h_tol, v_tol, max_vertical_gap + max_height)
+    return cKDTree(centers).query_pairs(r=radius, p=np.inf, output_type='ndarray')
+
+
+def merge_mask(i_idx: "np.ndarray", j_idx: "np.ndarray", arrays: BoxArrays, config: Dict) -> "np.ndarray":
+    """
+    Vectorized should_merge_boxes over the pairs (i_idx[k], j_idx[k]).
+    Center comparisons are done on doubled coordinates to stay in integers.
+    """
+    max_horizontal_gap, max_vertical_gap, h_tol, v_tol = grouping_thresholds(config)
+    x1, y1, x2, y2 = arrays
+
+    same_row = np.abs((y1[i_idx] + y2[i_idx]) - (y1[j_idx] + y2[j_idx])) <= 2 * h_tol
+    gap_right = x1[j_idx] - x2[i_idx]
+    gap_left = x1[i_idx] - x2[j_idx]
+    gap = np.where(gap_right >= 0, gap_right, np.where(gap_left >= 0, gap_left, 0))
+    horizontal = same_row & (gap <= max_horizontal_gap)
+
+    same_column = np.abs((x1[i_idx] + x2[i_idx]) - (x1[j_idx] + x2[j_idx])) <= 2 * v_tol
+    gap_below = y1[j_idx] - y2[i_idx]
+    gap_above = y1[i_idx] - y2[j_idx]
+    stacked = ((gap_below >= 0) & (gap_below <= max_vertical_gap)) | ((gap_above >= 0) & (gap_above <= max_vertical_gap))
+    return horizontal | (same_column & stacked)
+
+
+def connected_labels(n: int, pairs) -> List[int]:
+    """
+    Assigns a group label to each of n boxes so that boxes joined by any
+    chain of pairs share a label.
+    """
+    if np is not None:
+        pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+        _, labels = connected_components(graph, directed=False)
+        return labels.tolist()
+
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return [find(i) for i in range(n)]
+
+
 def improved_group_nearby_boxes(text_data: List[Box], config: Dict = None) -> List[Box]:
     if not text_data:
         return text_data
@@ -151,23 +222,20 @@ def improved_group_nearby_boxes(text_data: List[Box], config: Dict = None) -> Li
             'vertical_alignment_tolerance': 40,
         }
     boxes = [b.copy() for b in text_data]
+    n = len(boxes)
+    if np is not None:
+        arrays = box_arrays(boxes)
+        pairs = candidate_pairs(arrays, config)
+        pairs = pairs[merge_mask(pairs[:, 0], pairs[:, 1], arrays, config)]
+    else:
+        pairs = [(i, j) for i in range(n) for j in range(i + 1, n) if should_merge_boxes(boxes[i], boxes[j], config)]
+
+    groups: Dict[int, List[Box]] = {}
+    for box, label in zip(boxes, connected_labels(n, pairs)):
+        groups.setdefault(label, []).append(box)
+
     grouped: List[Box] = []
-    used = set()
-    for i, current in enumerate(boxes):
-        if i in used:
-            continue
-        group = [current]
-        used.add(i)
-        changed = True
-        while changed:
-            changed = False
-            for j, cand in enumerate(boxes):
-                if j in used:
-                    continue
-                if any(should_merge_boxes(g, cand, config) for g in group):
-                    group.append(cand)
-                    used.add(j)
-                    changed = True
+    for group in groups.values():
         merged = merge_boxes(group)
         merged['id'] = len(grouped)
         grouped.append(merged)
@@ -195,6 +263,10 @@ def visualize_bounding_boxes(image_path: str, text_data: List[Box], output_path:
     img = Image.open(image_path).convert("RGB")
     draw = ImageDraw.Draw(img)
     colors = ["red", "green", "blue", "purple", "orange", "cyan", "magenta", "yellow"]
+    try:
+        font = ImageFont.truetype("arial.ttf", 12)
+    except Exception:
+        font = ImageFont.load_default()
     for i, item in enumerate(text_data):
         box = item['bbox']
         x1, y1 = box['top_left']
@@ -203,10 +275,6 @@ def visualize_bounding_boxes(image_path: str, text_data: List[Box], output_path:
         color = colors[i % len(colors)]
         draw.rectangle([x1, y1, x2, y2], outline=color, width=3)
         label = f"ID:{item['id']} ({item.get('original_boxes',1)}): {text[:30]}..."
-        try:
-            font = ImageFont.truetype("arial.ttf", 12)
-        except Exception:
-            font = ImageFont.load_default()
         text_y = max(0, y1 - 20)
         if text_y + 16 > y1:
             text_y = y2 + 4
@@ -216,23 +284,21 @@ def visualize_bounding_boxes(image_path: str, text_data: List[Box], output_path:
     img.save(output_path)
 
 
-def generate_chatgpt_prompt(text_data: List[Box], image_path: str) -> str:
-    img = Image.open(image_path)
-    img_width, img_height = img.size
+def generate_chatgpt_prompt(text_data: List[Box], image_path: str, image_size: Tuple[int, int] = None) -> str:
+    if image_size is None:
+        image_size = Image.open(image_path).size
+    img_width, img_height = image_size
     sorted_data = sorted(text_data, key=lambda x: (x['bbox']['top_left'][1], x['bbox']['top_left'][0]))
 
-    prompt = f"You are an experienced mathematics and english teacher evaluating a student's handwritten solution. Focus on math/grammar; be tolerant to handwriting.\n\nImage size: {img_width}x{img_height} pixels\n\nDETECTED TEXT REGIONS:\n"
+    parts = [f"You are an experienced mathematics and english teacher evaluating a student's handwritten solution. Focus on math/grammar; be tolerant to handwriting.\n\nImage size: {img_width}x{img_height} pixels\n\nDETECTED TEXT REGIONS:\n"]
     for item in sorted_data:
         box = item['bbox']
         x1, y1 = box['top_left']
-        prompt += (
-            f"Region {item['id']}:\n"
-            f"Position: [{x1},{y1}] to [{box['bottom_right'][0]},{box['bottom_right'][1]}]\n"
-            f"Student wrote: \"{item['text']}\"\n---\n"
-        )
+        x2, y2 = box['bottom_right']
+        parts.append(REGION_TEMPLATE % (item['id'], x1, y1, x2, y2, item['text']))
 
-    prompt += "\nReturn strict JSON with fields: corrections[id,status,original_text,mathematical_interpretation,corrected_text,reasoning,marking,bbox{top_left,bottom_right},scratched], and overall_assessment{key_strengths,areas_for_improvement,final_answer_status}."
-    return prompt
+    parts.append("\nReturn strict JSON with fields: corrections[id,status,original_text,mathematical_interpretation,corrected_text,reasoning,marking,bbox{top_left,bottom_right},scratched], and overall_assessment{key_strengths,areas_for_improvement,final_answer_status}.")
+    return "".join(parts)
 
 
 def main():
@@ -242,15 +308,15 @@ def main():
     args = ap.parse_args()
 
     os.makedirs(args.out_dir, exist_ok=True)
-    data = extract_text_with_positions(args.image)
+    data, image_size, _ = extract_text_with_positions(args.image)
     visualize_bounding_boxes(args.image, data, os.path.join(args.out_dir, 'visualized_boxes.jpg'))
-    prompt = generate_chatgpt_prompt(data, args.image)
+    prompt = generate_chatgpt_prompt(data, args.image, image_size=image_size)
     with open(os.path.join(args.out_dir, 'chatgpt_prompt.txt'), 'w', encoding='utf-8') as f:
         f.write(prompt)
-    with open(os.path.join(args.out_dir, 'ocr_data.json'), 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
-    with open(os.path.join(args.out_dir, 'image_info.json'), 'w', encoding='utf-8') as f:
-        json.dump({'image_path': args.image}, f, indent=2)
+    with open(os.path.join(args.out_dir, 'ocr_data.json'), 'wb') as f:
+        f.write(dumps(data, indent=True))
+    with open(os.path.join(args.out_dir, 'image_info.json'), 'wb') as f:
+        f.write(dumps({'image_path': args.image}, indent=True))
 
 
 if __name__ == '__main__':
@@ -1,38 +1,79 @@
 ﻿#!/usr/bin/env python3
 import argparse
-import base64
-import json
+import asyncio
 import mimetypes
 import os
-import re
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
+from json_io import dumps, loads, read_bytes
 from config import (
+    get_async_openai_client,
     get_openai_client,
     openai_model_default,
     load_dotenv_if_available,
 )
 
+try:
+    from pybase64 import b64encode  # type: ignore
+except Exception:
+    # SIMD base64 is optional; the stdlib encoder produces identical output
+    from base64 import b64encode
 
-def encode_image_to_data_url(image_path: str) -> str:
+try:
+    import simdjson  # type: ignore
+    # Reused across calls; recursive parses return plain Python objects
+    _SIMDJSON_PARSER = simdjson.Parser()
+except Exception:
+    # Optional accelerated parser; orjson/stdlib is used otherwise
+    _SIMDJSON_PARSER = None
+
+
+def encode_image_to_data_url(image_path: str, image_bytes: Optional[bytes] = None) -> str:
     mime, _ = mimetypes.guess_type(image_path)
     if not mime:
         mime = "image/jpeg"
-    with open(image_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
+    if image_bytes is None:
+        image_bytes = read_bytes(image_path)
+    b64 = b64encode(image_bytes)
+    # Build the URL as bytes and decode once; base64 output is pure ASCII
+    return (f"data:{mime};base64,".encode("ascii") + b64).decode("ascii")
+
+
+def find_fenced_json(text: str) -> Optional[str]:
+    start = text.find("```")
+    while start != -1:
+        end = text.find("```", start + 3)
+        if end == -1:
+            return None
+        body = text[start + 3:end]
+        if body.startswith("json"):
+            body = body[4:]
+        body = body.strip()
+        if body.startswith("{") and body.endswith("}"):
+            return body
+        start = text.find("```", end + 3)
+    return None
+
+
+def parse_json_object(candidate: str) -> Dict[str, Any]:
+    if _SIMDJSON_PARSER is not None:
+        try:
+            return _SIMDJSON_PARSER.parse(candidate.encode("utf-8"), recursive=True)
+        except ValueError:
+            pass
+    return loads(candidate)
 
 
 def extract_json_from_text(text: str) -> Dict[str, Any]:
-    code_block = re.search(r"```(?:json)?\s*(\{[\s\S]*?\})\s*```", text)
-    candidate = code_block.group(1) if code_block else None
+    candidate = find_fenced_json(text)
     if not candidate:
-        brace_match = re.search(r"(\{[\s\S]*\})", text)
-        candidate = brace_match.group(1) if brace_match else None
+        start = text.find("{")
+        end = text.rfind("}")
+        candidate = text[start:end + 1] if start != -1 and end > start else None
     if not candidate:
         raise ValueError("No JSON object found in model response")
     cleaned = candidate.strip()
-    return json.loads(cleaned)
+    return parse_json_object(cleaned)
 
 
 def responses_text_output(resp) -> str:
@@ -51,14 +92,10 @@ def responses_text_output(resp) -> str:
     return "\n".join(parts) if parts else str(resp)
 
 
-def get_corrections_from_prompt(prompt: str, image_path: str) -> Dict[str, Any]:
-    load_dotenv_if_available()
-    client = get_openai_client()
-    model = openai_model_default()
-
+def build_input_payload(prompt: str, image_path: str, image_bytes: Optional[bytes] = None) -> List[Dict[str, Any]]:
     # Build multimodal input: prompt + image
-    data_url = encode_image_to_data_url(image_path)
-    input_payload = [
+    data_url = encode_image_to_data_url(image_path, image_bytes)
+    return [
         {
             "role": "user",
             "content": [
@@ -68,6 +105,32 @@ def get_corrections_from_prompt(prompt: str, image_path: str) -> Dict[str, Any]:
         }
     ]
 
+
+def openai_call_error(model: str, e: Exception) -> RuntimeError:
+    # Common case: model does not support images (e.g., o3)
+    return RuntimeError(
+        f"OpenAI call failed. Ensure the model supports images (e.g., gpt-4o, o4). Current model: {model}.\nOriginal error: {e}"
+    )
+
+
+def corrections_from_response(resp) -> Dict[str, Any]:
+    text = responses_text_output(resp)
+    data = extract_json_from_text(text)
+
+    if "corrections" not in data:
+        raise ValueError("Model response missing 'corrections' array")
+    if "overall_assessment" not in data:
+        data["overall_assessment"] = {}
+
+    return data
+
+
+def get_corrections_from_prompt(prompt: str, image_path: str, image_bytes: Optional[bytes] = None) -> Dict[str, Any]:
+    load_dotenv_if_available()
+    client = get_openai_client()
+    model = openai_model_default()
+    input_payload = build_input_payload(prompt, image_path, image_bytes)
+
     try:
         resp = client.responses.create(
             model=model,
@@ -76,20 +139,30 @@ def get_corrections_from_prompt(prompt: str, image_path: str) -> Dict[str, Any]:
             max_output_tokens=4096,
         )
     except Exception as e:
-        # Common case: model does not support images (e.g., o3)
-        raise RuntimeError(
-            f"OpenAI call failed. Ensure the model supports images (e.g., gpt-4o, o4). Current model: {model}.\nOriginal error: {e}"
-        )
+        raise openai_call_error(model, e)
 
-    text = responses_text_output(resp)
-    data = extract_json_from_text(text)
+    return corrections_from_response(resp)
 
-    if "corrections" not in data:
-        raise ValueError("Model response missing 'corrections' array")
-    if "overall_assessment" not in data:
-        data["overall_assessment"] = {}
 
-    return data
+async def get_corrections_from_prompt_async(prompt: str, image_path: str, image_bytes: Optional[bytes] = None) -> Dict[str, Any]:
+    load_dotenv_if_available()
+    model = openai_model_default()
+    # Reading and encoding the image is blocking work; keep it off the event loop
+    input_payload = await asyncio.to_thread(build_input_payload, prompt, image_path, image_bytes)
+
+    # Close the client's connection pool before the event loop goes away
+    async with get_async_openai_client() as client:
+        try:
+            resp = await client.responses.create(
+                model=model,
+                input=input_payload,
+                temperature=0.2,
+                max_output_tokens=4096,
+            )
+        except Exception as e:
+            raise openai_call_error(model, e)
+
+    return corrections_from_response(resp)
 
 
 def main():
@@ -104,8 +177,8 @@ def main():
 
     data = get_corrections_from_prompt(prompt, args.image)
 
-    with open(args.output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    with open(args.output_file, "wb") as f:
+        f.write(dumps(data, indent=True))
 
     print(f"Wrote corrections to {args.output_file}")
 
@@ -0,0 +1,46 @@
+﻿#!/usr/bin/env python3
+import json
+import os
+from typing import Any, Union
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    # Fall back to the stdlib encoder if orjson is not installed
+    orjson = None
+
+READ_BUFFER_SIZE = 1 << 20
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serializes obj to UTF-8 encoded JSON bytes.
+    Non-ASCII text is written as-is rather than escaped.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
+
+
+def read_bytes(path: str) -> bytes:
+    """
+    Reads a whole file with a 1 MB buffer, hinting sequential access to the
+    kernel where posix_fadvise is available (Linux).
+    """
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        return f.read()
+
+
+def read_json(path: str) -> Any:
+    return loads(read_bytes(path))
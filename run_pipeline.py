@@ -1,18 +1,19 @@
 ﻿#!/usr/bin/env python3
 import argparse
+import asyncio
 import datetime as dt
-import json
 import os
 import pathlib
 import sys
 
 # Local imports
+from json_io import dumps, read_json
 from extract_text_positions import (
     extract_text_with_positions,
     generate_chatgpt_prompt,
     visualize_bounding_boxes,
 )
-from gpt_corrections import get_corrections_from_prompt
+from gpt_corrections import get_corrections_from_prompt_async
 
 
 def ensure_dir(p: str) -> str:
@@ -20,60 +21,85 @@ def ensure_dir(p: str) -> str:
     return p
 
 
-def run_pipeline(
+def write_json(path: str, obj) -> None:
+    with open(path, "wb") as f:
+        f.write(dumps(obj, indent=True))
+
+
+def write_text(path: str, text: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def try_visualize_bounding_boxes(image_path: str, text_data, output_path: str) -> None:
+    try:
+        visualize_bounding_boxes(image_path, text_data, output_path)
+    except Exception:
+        pass
+
+
+async def load_or_request_corrections(
+    prompt: str,
+    image_path: str,
+    out_dir: str,
+    use_corrections_json: str = None,
+    skip_openai: bool = False,
+    image_bytes: bytes = None,
+):
+    if use_corrections_json:
+        return read_json(use_corrections_json)
+    if not skip_openai:
+        return await get_corrections_from_prompt_async(prompt, image_path, image_bytes=image_bytes)
+    return read_json(os.path.join(out_dir, 'corrections.json'))
+
+
+async def run_pipeline(
     image_path: str,
     out_dir: str,
     use_ocr_json: str = None,
     use_corrections_json: str = None,
     skip_ocr: bool = False,
     skip_openai: bool = False,
+    save_overlay: bool = False,
 ) -> None:
     out_dir = ensure_dir(out_dir)
 
     # 1) Extract text + boxes
+    image_size = None
+    image_bytes = None
     if use_ocr_json:
-        with open(use_ocr_json, 'r', encoding='utf-8') as f:
-            text_data = json.load(f)
+        text_data = read_json(use_ocr_json)
     elif not skip_ocr:
-        text_data = extract_text_with_positions(image_path)
+        text_data, image_size, image_bytes = extract_text_with_positions(image_path)
     else:
-        with open(os.path.join(out_dir, 'ocr_data.json'), 'r', encoding='utf-8') as f:
-            text_data = json.load(f)
-
-    # 2) Visualize boxes
-    boxes_img = os.path.join(out_dir, "visualized_boxes.jpg")
-    try:
-        visualize_bounding_boxes(image_path, text_data, boxes_img)
-    except Exception:
-        pass
+        text_data = read_json(os.path.join(out_dir, 'ocr_data.json'))
 
-    # 3) Build prompt
-    prompt = generate_chatgpt_prompt(text_data, image_path)
+    # 2) Build prompt
+    prompt = generate_chatgpt_prompt(text_data, image_path, image_size=image_size)
     prompt_path = os.path.join(out_dir, "chatgpt_prompt.txt")
-    with open(prompt_path, "w", encoding="utf-8") as f:
-        f.write(prompt)
 
-    # 4) Call OpenAI (vision) for corrections
-    if use_corrections_json:
-        with open(use_corrections_json, 'r', encoding='utf-8') as f:
-            corrections = json.load(f)
-    elif not skip_openai:
-        corrections = get_corrections_from_prompt(prompt, image_path)
-    else:
-        with open(os.path.join(out_dir, 'corrections.json'), 'r', encoding='utf-8') as f:
-            corrections = json.load(f)
+    # 3) Call OpenAI (vision) for corrections while the box preview and
+    #    OCR artifacts are written in worker threads
+    boxes_img = os.path.join(out_dir, "visualized_boxes.jpg")
+    results = await asyncio.gather(
+        load_or_request_corrections(prompt, image_path, out_dir, use_corrections_json, skip_openai, image_bytes),
+        asyncio.to_thread(try_visualize_bounding_boxes, image_path, text_data, boxes_img),
+        asyncio.to_thread(write_text, prompt_path, prompt),
+        asyncio.to_thread(write_json, os.path.join(out_dir, "ocr_data.json"), text_data),
+        asyncio.to_thread(write_json, os.path.join(out_dir, "image_info.json"), {"image_path": image_path}),
+        return_exceptions=True,
+    )
+    # Surface failures only after every write has finished, so a failed
+    # OpenAI call still leaves the same set of debug artifacts behind
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    corrections = results[0]
 
     corrections_path = os.path.join(out_dir, "corrections.json")
-    with open(corrections_path, "w", encoding="utf-8") as f:
-        json.dump(corrections, f, indent=2, ensure_ascii=False)
+    write_json(corrections_path, corrections)
 
-    # 5) Save OCR data and image info
-    with open(os.path.join(out_dir, "ocr_data.json"), "w", encoding="utf-8") as f:
-        json.dump(text_data, f, indent=2, ensure_ascii=False)
-    with open(os.path.join(out_dir, "image_info.json"), "w", encoding="utf-8") as f:
-        json.dump({"image_path": image_path}, f, indent=2)
-
-    # 6) Create overlays
+    # 4) Create overlays
     from create_overlay import create_overlay
     overlay_png = os.path.join(out_dir, "corrected_overlay.png")
     overlay_path, composite_path = create_overlay(
@@ -82,16 +108,22 @@ def run_pipeline(
         corrections.get("overall_assessment", {}),
         font_size=32,
         output_path=overlay_png,
+        save_overlay=save_overlay,
     )
 
     print("Pipeline complete.")
     print(f"- Boxes: {boxes_img}")
     print(f"- Prompt: {prompt_path}")
     print(f"- Corrections: {corrections_path}")
-    print(f"- Overlay: {overlay_path}")
+    if overlay_path:
+        print(f"- Overlay: {overlay_path}")
     print(f"- Composite: {composite_path}")
 
 
+def run_pipeline_sync(*args, **kwargs) -> None:
+    asyncio.run(run_pipeline(*args, **kwargs))
+
+
 def main():
     ap = argparse.ArgumentParser(description="OCR -> Prompt -> OpenAI (vision) -> Overlay pipeline")
     ap.add_argument("--image", required=True, help="Path to source image")
@@ -100,6 +132,7 @@ def main():
     ap.add_argument("--use-corrections", default=None, help="Use existing corrections JSON instead of calling OpenAI")
     ap.add_argument("--skip-ocr", action="store_true", help="Skip Vision (expects ocr_data.json in out-dir)")
     ap.add_argument("--skip-openai", action="store_true", help="Skip OpenAI (expects corrections.json in out-dir)")
+    ap.add_argument("--save-overlay", action="store_true", help="Also save the transparent overlay PNG")
     args = ap.parse_args()
 
     image_path = args.image
@@ -108,13 +141,14 @@ def main():
         sys.exit(1)
 
     out_dir = args.out_dir or os.path.join("outputs", dt.datetime.now().strftime("%Y%m%d_%H%M%S"))
-    run_pipeline(
+    run_pipeline_sync(
         image_path,
         out_dir,
         use_ocr_json=args.use_ocr_json,
         use_corrections_json=args.use_corrections,
         skip_ocr=args.skip_ocr,
         skip_openai=args.skip_openai,
+        save_overlay=args.save_overlay,
     )
 
 